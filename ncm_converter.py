@@ -1,22 +1,28 @@
 import os
 import json
 import base64
-import struct
 import logging
-import binascii
-from glob import glob
+import mmap
+import functools
+import numpy as np
 from tqdm.auto import tqdm
 from textwrap import dedent
 from multiprocessing import Pool
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from cryptography.hazmat.backends import default_backend
+from concurrent.futures import ThreadPoolExecutor
+try:
+    from Crypto.Cipher import AES  # PyCryptodome: one AES-NI call per decrypt
+except ImportError:  # fall back to the cryptography package
+    AES = None
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    from cryptography.hazmat.backends import default_backend
 from datetime import datetime
-from io import BytesIO
-import win32pipe
-import win32file
 import subprocess
-import threading
+import tempfile
 import sys
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
 
 
 class TqdmLoggingHandler(logging.StreamHandler):
@@ -43,12 +49,17 @@ fmt = '%(levelname)7s [%(asctime)s] %(message)s'
 datefmt = '%Y-%m-%d %H:%M:%S'
 handler.setFormatter(logging.Formatter(fmt, datefmt))
 log.addHandler(handler)
-DEFAULT_CHUNK_SIZE = 65536
+MIN_THREAD_SEGMENT_SIZE = 1 << 20
+PIPE_BUFFER_SIZE = 1 << 20
+# RAM-backed tmpfs for staging the cover image, where the platform has one
+TMPFS_DIR = '/dev/shm' if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK) else None
+_CORE_KEY = bytes.fromhex('687A4852416D736F356B496E62617857')
+_META_KEY = bytes.fromhex('2331346C6A6B5F215C5D2630553C2728')
 
 
+@functools.lru_cache(maxsize=1)
 def find_ffmpeg() -> str | None:
-    paths = sys.path
-    paths += os.environ['PATH'].split(';')
+    paths = sys.path + os.environ['PATH'].split(';')
     for path in paths:
         if len(path) == 0:
             continue
@@ -58,44 +69,103 @@ def find_ffmpeg() -> str | None:
             return full_path
 
 
-def create_pipe(pipe_name):
-    return win32pipe.CreateNamedPipe(
-        pipe_name, win32pipe.PIPE_ACCESS_DUPLEX,
-        win32pipe.PIPE_TYPE_MESSAGE | win32pipe.PIPE_READMODE_MESSAGE | win32pipe.PIPE_WAIT,
-        1, DEFAULT_CHUNK_SIZE, DEFAULT_CHUNK_SIZE, 0, None  # pyright:ignore[reportArgumentType]
-    )
+def merge_audio_with_cover(ffmpeg_path, blob_audio, blob_cover_img, output_file):
+    # the cover image is staged in a (preferably in-memory) temp file and the audio streamed through
+    # ffmpeg's stdin; a SpooledTemporaryFile would not work here as ffmpeg needs a real path to open
+    with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False, dir=TMPFS_DIR) as img_file:
+        img_file.write(blob_cover_img)
+    try:
+        cmd = [ffmpeg_path, '-v', 'quiet', '-y', '-i', img_file.name, '-i', 'pipe:0', '-c', 'copy', '-map', '0:0', '-disposition:v', 'attached_pic', '-map', '1', '-map_metadata', '1', output_file]
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+        if fcntl is not None and hasattr(fcntl, 'F_SETPIPE_SZ'):
+            # a larger pipe lets the whole write run ahead of ffmpeg with fewer wake-ups
+            try:
+                fcntl.fcntl(proc.stdin, fcntl.F_SETPIPE_SZ, PIPE_BUFFER_SIZE)
+            except OSError:
+                pass
+        proc.communicate(blob_audio)
+        assert proc.returncode == 0
+    finally:
+        os.remove(img_file.name)
 
 
-def connect_and_write_pipe(pipe_fd, data):
-    win32pipe.ConnectNamedPipe(pipe_fd, None)
-    with memoryview(data) as mv:
-        for i in range(0, len(data), DEFAULT_CHUNK_SIZE):
-            win32file.WriteFile(pipe_fd, mv[i:i+DEFAULT_CHUNK_SIZE])
-    win32file.CloseHandle(pipe_fd)
+def _ecb_decryptor(key: bytes):
+    # returns a function decrypting a whole AES-ECB blob (without unpadding)
+    if AES is not None:
+        return AES.new(key, AES.MODE_ECB).decrypt
+    cipher = Cipher(algorithms.AES(key), modes.ECB(), backend=default_backend())
 
+    def decrypt(data: bytes) -> bytes:
+        cryptor = cipher.decryptor()
+        return cryptor.update(data) + cryptor.finalize()
+    return decrypt
+
+
+_core_decrypt = _ecb_decryptor(_CORE_KEY)
+_meta_decrypt = _ecb_decryptor(_META_KEY)
 
-def merge_audio_with_cover(ffmpeg_path, blob_audio, blob_cover_img, output_file):
-    pid = os.getpid()
-    named_pipe_img = rf'\\.\pipe\ncm_conv_{pid}_img'
-    named_pipe_audio = rf'\\.\pipe\ncm_conv_{pid}_audio'
-    img_pipe = None
-    audio_pipe = None
-    try:
-        img_pipe = create_pipe(named_pipe_img)
-        audio_pipe = create_pipe(named_pipe_audio)
-        cmd = [ffmpeg_path, '-v', 'quiet', '-y', '-i', named_pipe_img, '-i', named_pipe_audio, '-c', 'copy', '-map', '0:0', '-disposition:v', 'attached_pic', '-map', '1', '-map_metadata', '1', output_file]
-        proc = subprocess.Popen(cmd)
-        connect_and_write_pipe(img_pipe, blob_cover_img)
-        connect_and_write_pipe(audio_pipe, blob_audio)
-        assert proc.wait() == 0
-    finally:
-        if img_pipe:
-            win32file.CloseHandle(img_pipe)
-        if audio_pipe:
-            win32file.CloseHandle(audio_pipe)
 
+def _unpad(s: bytes) -> bytes:
+    # PKCS#7; fail loudly on malformed padding rather than returning garbage
+    assert 1 <= s[-1] <= 16
+    return s[:-s[-1]]
 
-def dump_single_file(filepath, target_folder, after_timestamp=None, ffmpeg_path=None):
+
+def build_key_box(key_data: bytes) -> np.ndarray:
+    # RC4-style key scheduling: 256 iterations over a bytearray, cheaper than any JIT warm-up
+    key_length = len(key_data)
+    key_box = bytearray(range(256))
+
+    c = 0
+    last_byte = 0
+    key_offset = 0
+    for i in range(256):
+        swap = key_box[i]
+        c = (swap + last_byte + key_data[key_offset]) & 0xff
+        key_offset += 1
+        if key_offset >= key_length:
+            key_offset = 0
+        key_box[i] = key_box[c]
+        key_box[c] = swap
+        last_byte = c
+    return np.frombuffer(key_box, dtype=np.uint8)
+
+
+def _xor_keystream(src, dst, ks):
+    # src and dst must start on a 256-byte keystream period boundary and share the same alignment
+    # modulo 8; past an unaligned head the bulk is XORed a uint64 word at a time
+    head = min(-src.ctypes.data % 8, src.size)
+    np.bitwise_xor(src[:head], ks[:head], out=dst[:head])
+    src, dst, ks = src[head:], dst[head:], np.roll(ks, -head)
+    n = src.size - src.size % 256
+    np.bitwise_xor(src[:n].view(np.uint64).reshape(-1, 32), ks.view(np.uint64),
+                   out=dst[:n].view(np.uint64).reshape(-1, 32))
+    np.bitwise_xor(src[n:], ks[:src.size - n], out=dst[n:])
+
+
+def decrypt_audio(data, key_box, n_threads=1):
+    # the keystream byte at offset i only depends on (i + 1) & 0xff, so one 256-byte period is
+    # computed up front and broadcast over the whole audio blob
+    j = np.arange(1, 257) & 0xff
+    key_box = key_box.astype(np.intp)
+    ks = key_box[(key_box[j] + key_box[(key_box[j] + j) & 0xff]) & 0xff].astype(np.uint8)
+
+    # offset the output by the input's misalignment so both can be viewed as uint64 words
+    shift = data.ctypes.data % 8
+    out = np.empty(data.size + 8, dtype=np.uint8)[shift:shift + data.size]
+    n_threads = max(1, min(n_threads, data.size // MIN_THREAD_SEGMENT_SIZE))
+    if n_threads > 1:
+        # NumPy releases the GIL inside the XOR, so period-aligned slices decrypt in parallel
+        seg_size = (-(-data.size // n_threads) + 255) & ~255
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            list(executor.map(lambda i: _xor_keystream(data[i:i+seg_size], out[i:i+seg_size], ks),
+                              range(0, data.size, seg_size)))
+    else:
+        _xor_keystream(data, out, ks)
+    return out.data
+
+
+def dump_single_file(filepath, target_folder, after_timestamp=None, ffmpeg_path=None, n_threads=1, existing=None):
     try:
         if after_timestamp:
             creation_time = os.path.getctime(filepath)
@@ -105,88 +175,49 @@ def dump_single_file(filepath, target_folder, after_timestamp=None, ffmpeg_path=
         filename = os.path.basename(filepath)  # Use os.path.basename for Windows compatibility
         if not filename.endswith('.ncm'): return
         filename = filename[:-4]
-        for ftype in ['mp3', 'flac']:
-            fname = os.path.join(target_folder, f'{filename}.{ftype}')
-            if os.path.isfile(fname):
-                log.warning(f'Skipping "{filepath}" due to existing file "{fname}"')
-                return
+        if existing is None:
+            candidates = (os.path.join(target_folder, f'{filename}.{ftype}') for ftype in ['mp3', 'flac'])
+            fname = next((fp for fp in candidates if os.path.isfile(fp)), None)
+        else:
+            fname = existing.get(os.path.normcase(os.path.join(target_folder, filename)))
+        if fname:
+            log.warning(f'Skipping "{filepath}" due to existing file "{fname}"')
+            return
 
         log.info(f'Converting "{filepath}"')
 
-        # hex to str
-        core_key = binascii.a2b_hex('687A4852416D736F356B496E62617857')
-        meta_key = binascii.a2b_hex('2331346C6A6B5F215C5D2630553C2728')
-        unpad = lambda s: s[0:-(s[-1] if isinstance(s[-1], int) else ord(s[-1]))]
-        with open(filepath, 'rb') as f:
-            header = f.read(8)
-            
-            # str to hex
-            assert binascii.b2a_hex(header) == b'4354454e4644414d'
-            f.seek(2, 1)
-            key_length = f.read(4)
-            key_length = struct.unpack('<I', bytes(key_length))[0]
-            key_data = f.read(key_length)
-            key_data_array = bytearray(key_data)
-            for i in range(0, len(key_data_array)):
-                key_data_array[i] ^= 0x64
-            key_data = bytes(key_data_array)
-            cryptor = Cipher(algorithms.AES(core_key), modes.ECB(), backend=default_backend()).decryptor()
-            key_data = unpad(cryptor.update(key_data) + cryptor.finalize())[17:]
-            key_length = len(key_data)
-            key_data = bytearray(key_data)
-            key_box = bytearray(range(256))
-
-            c = 0
-            last_byte = 0
-            key_offset = 0
-            for i in range(256):
-                swap = key_box[i]
-                c = (swap + last_byte + key_data[key_offset]) & 0xff
-                key_offset += 1
-                if key_offset >= key_length:
-                    key_offset = 0
-                key_box[i] = key_box[c]
-                key_box[c] = swap
-                last_byte = c
-
-            meta_length = f.read(4)
-            meta_length = struct.unpack('<I', bytes(meta_length))[0]
-            meta_data = f.read(meta_length)
-            meta_data_array = bytearray(meta_data)
-            for i in range(0, len(meta_data_array)):
-                meta_data_array[i] ^= 0x63
-            meta_data = bytes(meta_data_array)
-            meta_data = base64.b64decode(meta_data[22:])
-            cryptor = Cipher(algorithms.AES(meta_key), modes.ECB(), backend=default_backend()).decryptor()
-            meta_data = unpad(cryptor.update(meta_data) + cryptor.finalize()).decode('utf-8')[6:]
-            meta_data = json.loads(meta_data)
-
-            crc32 = f.read(4)
-            crc32 = struct.unpack('<I', bytes(crc32))[0]
-            f.seek(5, 1)
-            image_size = f.read(4)
-            image_size = struct.unpack('<I', bytes(image_size))[0]
-            image_data = f.read(image_size)
+        with open(filepath, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                # the file is consumed front to back once, so ask for aggressive read-ahead
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            header = mm.read(8)
+            assert header == b'CTENFDAM'
+            mm.seek(2, 1)
+            key_length = int.from_bytes(mm.read(4), 'little')
+            key_data = (np.frombuffer(mm.read(key_length), dtype=np.uint8) ^ 0x64).tobytes()
+            key_data = _unpad(_core_decrypt(key_data))[17:]
+            key_box = build_key_box(key_data)
+
+            meta_length = int.from_bytes(mm.read(4), 'little')
+            # the first 22 bytes are a fixed "163 key(Don't modify):" tag that is never used, so skip them
+            mm.seek(22, 1)
+            meta_data = (np.frombuffer(mm.read(meta_length - 22), dtype=np.uint8) ^ 0x63).tobytes()
+            meta_data = json.loads(_unpad(_meta_decrypt(base64.b64decode(meta_data)))[6:])
+
+            crc32 = int.from_bytes(mm.read(4), 'little')
+            mm.seek(5, 1)
+            image_size = int.from_bytes(mm.read(4), 'little')
+            image_data = mm.read(image_size)
             target_filename = os.path.join(target_folder, f'{filename}.{meta_data["format"]}')
 
-            with BytesIO() as m:
-                chunk = bytearray()
-                while True:
-                    chunk = bytearray(f.read(0x8000))
-                    chunk_length = len(chunk)
-                    if not chunk:
-                        break
-                    for i in range(1, chunk_length + 1):
-                        j = i & 0xff
-                        chunk[i - 1] ^= key_box[(key_box[j] + key_box[(key_box[j] + j) & 0xff]) & 0xff]
-                    m.write(chunk)
-
-                audio_data = m.getvalue()
-                if ffmpeg_path:
-                    merge_audio_with_cover(ffmpeg_path, audio_data, image_data, target_filename)
-                else:
-                    with open(target_filename, 'wb') as m:
-                        m.write(audio_data)
+            # the audio ciphertext is handed over as a zero-copy view into the mapping, and the decrypted
+            # buffer goes straight to ffmpeg or disk without another in-memory copy
+            audio_data = decrypt_audio(np.frombuffer(mm, dtype=np.uint8, offset=mm.tell()), key_box, n_threads)
+            if ffmpeg_path:
+                merge_audio_with_cover(ffmpeg_path, audio_data, image_data, target_filename)
+            else:
+                with open(target_filename, 'wb') as m:
+                    m.write(audio_data)
         log.info(f'Converted file saved at "{target_filename}"')
         return target_filename
 
@@ -195,16 +226,71 @@ def dump_single_file(filepath, target_folder, after_timestamp=None, ffmpeg_path=
         quit()
 
 
-def list_filepaths(path):
+def iter_ncm_filepaths(path):
     if os.path.isfile(path):
-        return [path]
+        yield path
     elif os.path.isdir(path):
-        return [fp for p in glob(os.path.join(path, '*')) for fp in list_filepaths(p)]
+        # DirEntry carries the file type from the directory listing, so no extra stat per entry
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.name.startswith('.'):
+                    # hidden entries (e.g. AppleDouble '._x.ncm' stubs, .Trash) were never matched by glob('*')
+                    continue
+                if entry.is_dir():
+                    yield from iter_ncm_filepaths(entry.path)
+                elif entry.name.endswith('.ncm'):
+                    yield entry.path
     else:
         raise ValueError(f'path not recognized: {path}')
 
-def process_file(fp, target_folder, after_timestamp, ffmpeg_path):
-    dump_single_file(fp, target_folder or os.path.dirname(fp), after_timestamp, ffmpeg_path)
+def list_existing_outputs(folders):
+    # maps "<folder>/<name>" to an already converted "<folder>/<name>.<ext>", so the skip check is a
+    # dict lookup instead of a couple of stat calls per source file; keys are normcase'd and the
+    # extension matched case-insensitively, as os.path.isfile would on Windows
+    existing = {}
+    for folder in folders:
+        if not os.path.isdir(folder or '.'):
+            continue
+        for name in os.listdir(folder or '.'):
+            if name.lower().endswith(('.mp3', '.flac')):
+                key = os.path.normcase(os.path.join(folder, os.path.splitext(name)[0]))
+                existing.setdefault(key, os.path.join(folder, name))
+    return existing
+
+def drop_taken_targets(filepaths, target_folder, after_timestamp, existing):
+    # resolve skips in the parent, in source order, so a later source whose output name is already
+    # on disk or claimed by an earlier source is skipped exactly as a sequential run would
+    claimed = {}
+    pending = []
+    for fp in filepaths:
+        filename = os.path.basename(fp)
+        if filename.endswith('.ncm') and not (after_timestamp and os.path.getctime(fp) < after_timestamp):
+            key = os.path.normcase(os.path.join(target_folder or os.path.dirname(fp), filename[:-4]))
+            if key in existing:
+                log.warning(f'Skipping "{fp}" due to existing file "{existing[key]}"')
+                continue
+            if key in claimed:
+                log.warning(f'Skipping "{fp}" due to "{claimed[key]}" converting to the same file')
+                continue
+            claimed[key] = fp
+        pending.append(fp)
+    return pending
+
+_worker_ffmpeg_path = None
+_worker_n_threads = 1
+_worker_existing = None
+
+
+def _init_worker(ffmpeg_path, n_threads, existing):
+    # per-run settings are stashed once per worker process rather than pickled with every task
+    global _worker_ffmpeg_path, _worker_n_threads, _worker_existing
+    _worker_ffmpeg_path = ffmpeg_path
+    _worker_n_threads = n_threads
+    _worker_existing = existing
+
+def process_file(fp, target_folder, after_timestamp):
+    dump_single_file(fp, target_folder or os.path.dirname(fp), after_timestamp, _worker_ffmpeg_path, _worker_n_threads,
+                     _worker_existing)
 
 def dump(*paths, n_workers=1, target_folder=None, after_timestamp=None, ffmpeg_path=None):
     header = dedent(r'''
@@ -221,16 +307,24 @@ def dump(*paths, n_workers=1, target_folder=None, after_timestamp=None, ffmpeg_p
 
     if ffmpeg_path is None:
         ffmpeg_path = find_ffmpeg()
-    all_filepaths = [fp for p in paths for fp in list_filepaths(p)]
+    all_filepaths = [fp for p in paths for fp in iter_ncm_filepaths(p)]
+    existing = list_existing_outputs({target_folder or os.path.dirname(fp) for fp in all_filepaths})
+    all_filepaths = drop_taken_targets(all_filepaths, target_folder, after_timestamp, existing)
     if n_workers > 1:
         log.info(f'Running pyNCMDUMP with up to {n_workers} parallel workers')
-        with Pool(processes=n_workers) as p:
-            list(p.starmap(process_file, [(fp, target_folder, after_timestamp, ffmpeg_path) for fp in all_filepaths]))
-            # list(p.map(lambda fp: process_file(fp, target_folder, after_timestamp), all_filepaths))  # Use the new function
+        # leftover cores are shared out as decryption threads within each worker
+        n_threads = max(1, (os.cpu_count() or 1) // n_workers)
+        with Pool(processes=n_workers, initializer=_init_worker, initargs=(ffmpeg_path, n_threads, existing)) as p:
+            # unordered results with batched tasks keep workers busy when file sizes vary widely
+            chunksize = max(1, len(all_filepaths) // (4 * n_workers))
+            worker = functools.partial(process_file, target_folder=target_folder, after_timestamp=after_timestamp)
+            for _ in tqdm(p.imap_unordered(worker, all_filepaths, chunksize=chunksize), total=len(all_filepaths), leave=False):
+                pass
     else:
         log.info('Running pyNCMDUMP on single-worker mode')
+        n_threads = os.cpu_count() or 1
         for fp in tqdm(all_filepaths, leave=False):
-            dump_single_file(fp, target_folder or os.path.dirname(fp), after_timestamp, ffmpeg_path)  # Use target_folder
+            dump_single_file(fp, target_folder or os.path.dirname(fp), after_timestamp, ffmpeg_path, n_threads, existing)
     log.info('All finished')
 
 